@@ -10,15 +10,21 @@ Usage:
 """
 
 import argparse
+import functools
+import itertools
 import json
-import shutil
+import mmap
+import operator
+import re
+import tempfile
+import orjson
+from contextlib import ExitStack
 from pathlib import Path
-from collections import defaultdict
 from dataclasses import dataclass
-from typing import List, Dict, Tuple, Optional
+from typing import List, Tuple, Optional, Iterable, Iterator, Union
 
 
-@dataclass
+@dataclass(slots=True)
 class ToMiExample:
     """A single example from the ToMi dataset."""
     story: str
@@ -31,51 +37,87 @@ class ToMiExample:
     base_question_type: str  # e.g., "first_order_0" without _tom/_no_tom suffix
 
 
-def parse_trace_line(trace_line: str) -> Tuple[str, str, str]:
-    """Parse trace line to get story_structure, question_type, story_type."""
-    parts = trace_line.strip().split(',')
-    story_type = parts[-1]
-    question_type = parts[-2]
-    story_structure = ','.join(parts[:-2])
-    return story_structure, question_type, story_type
+# Pre-encoded key fragments for the JSONL records, so that only the values
+# need to go through the encoder for each example
+_STORY_KEY = b'{"story":'
+_QUESTION_KEY = b',"question":'
+_ANSWER_KEY = b',"answer":'
+_QUESTION_TYPE_KEY = b',"question_type":'
+_STORY_TYPE_KEY = b',"story_type":'
+_REQUIRES_TOM_KEY = b',"requires_tom":'
+_TOM_ORDER_KEY = b',"tom_order":'
+_BASE_QUESTION_TYPE_KEY = b',"base_question_type":'
 
+# Reads all record fields of an example in one call
+_record_fields = operator.attrgetter(
+    'story', 'question', 'answer', 'question_type', 'story_type', 'requires_tom', 'tom_order')
 
+
+def encode_example(ex: ToMiExample) -> bytes:
+    """Encode an example as a JSONL record (without base_question_type)."""
+    story, question, answer, question_type, story_type, requires_tom, tom_order = _record_fields(ex)
+    dumps = orjson.dumps
+    return b''.join([
+        _STORY_KEY, dumps(story),
+        _QUESTION_KEY, dumps(question),
+        _ANSWER_KEY, dumps(answer),
+        _QUESTION_TYPE_KEY, dumps(question_type),
+        _STORY_TYPE_KEY, dumps(story_type),
+        _REQUIRES_TOM_KEY, b'true' if requires_tom else b'false',
+        _TOM_ORDER_KEY, dumps(tom_order),
+        b'}\n',
+    ])
+
+
+def add_base_question_type(lines: bytes, base_type: str) -> bytes:
+    """
+    Append a base_question_type field to every record of an encoded group.
+    
+    orjson escapes newlines inside strings, so b'}\\n' only occurs at the end
+    of a record and the records do not need to be encoded again.
+    """
+    return lines.replace(b'}\n', _BASE_QUESTION_TYPE_KEY + orjson.dumps(base_type) + b'}\n')
+
+
+def parse_trace_line(trace_line: str) -> Tuple[str, str]:
+    """Parse trace line to get question_type, story_type (the last two fields)."""
+    parts = trace_line.strip().rsplit(',', 2)
+    return parts[-2], parts[-1]
+
+
+# ToM question types, e.g. "second_order_1_no_tom"
+_QUESTION_TYPE_RE = re.compile(r'(?P<order>first|second)_order_(?P<which>[01])_(?P<tom>no_tom|tom)')
+
+
+@functools.lru_cache(maxsize=None)
 def parse_question_type(question_type: str) -> Tuple[bool, Optional[int], str]:
     """
     Parse question type.
+    Cached, since ToMi only has a handful of distinct question types.
     Returns: (requires_tom, tom_order, base_type)
     """
-    if question_type in ('memory', 'reality'):
-        return False, None, question_type
-    
-    requires_tom = question_type.endswith('_tom') and not question_type.endswith('_no_tom')
-    
-    if 'first_order' in question_type:
-        tom_order = 1
-        if '_0_' in question_type:
-            base_type = 'first_order_0'
-        else:
-            base_type = 'first_order_1'
-    elif 'second_order' in question_type:
-        tom_order = 2
-        if '_0_' in question_type:
-            base_type = 'second_order_0'
-        else:
-            base_type = 'second_order_1'
-    else:
-        tom_order = None
-        base_type = question_type
+    match = _QUESTION_TYPE_RE.fullmatch(question_type)
+    if match is None:
+        # Control questions ('memory', 'reality') and any other types are
+        # their own base type
+        requires_tom = question_type.endswith('_tom') and not question_type.endswith('_no_tom')
+        return requires_tom, None, question_type
+    
+    order, which, tom = match.group('order', 'which', 'tom')
+    requires_tom = tom == 'tom'
+    tom_order = 1 if order == 'first' else 2
+    base_type = f'{order}_order_{which}'
     
     return requires_tom, tom_order, base_type
 
 
-def parse_story_block(lines: List[str]) -> Tuple[str, str, str]:
+def parse_story_block(block: str) -> Tuple[str, str, str]:
     """Parse a story block from the txt file."""
     story_lines = []
     question = ""
     answer = ""
     
-    for line in lines:
+    for line in block.split('\n'):
         line = line.strip()
         if not line:
             continue
@@ -91,8 +133,47 @@ def parse_story_block(lines: List[str]) -> Tuple[str, str, str]:
     return story, question, answer
 
 
-def load_tomi_data(data_dir: Path, split: str = 'test') -> List[ToMiExample]:
-    """Load ToMi data from txt and trace files."""
+def iter_trace_lines(trace_file: Path) -> Iterator[str]:
+    """Yield non-empty lines from a trace file."""
+    with open(trace_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def find_block_offsets(data: Union[bytes, mmap.mmap]) -> List[int]:
+    """
+    Find where each story block starts, i.e. every line beginning with '1 '.
+    Returns: block start offsets followed by len(data), so block k is data[offsets[k]:offsets[k + 1]]
+    """
+    offsets = [0]
+    i = data.find(b'\n1 ')
+    while i >= 0:
+        offsets.append(i + 1)
+        i = data.find(b'\n1 ', i + 1)
+    offsets.append(len(data))
+    return offsets
+
+
+def iter_story_blocks(txt_file: Path) -> Iterator[str]:
+    """Yield story blocks from a txt file, one string per example."""
+    if txt_file.stat().st_size == 0:
+        return
+    
+    # Blocks are sliced out of the memory-mapped file and only decoded when yielded
+    with open(txt_file, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            memoryview(data) as view:
+        offsets = find_block_offsets(data)
+        for start, end in zip(offsets, offsets[1:]):
+            block = str(view[start:end], 'utf-8')
+            if block and not block.isspace():
+                yield block
+
+
+def find_data_files(data_dir: Path, split: str = 'test') -> Tuple[Path, Path]:
+    """Find the txt and trace files for a split. Returns: (txt_file, trace_file)"""
     
     # Try different filename patterns
     patterns = [
@@ -100,53 +181,46 @@ def load_tomi_data(data_dir: Path, split: str = 'test') -> List[ToMiExample]:
         (f'{split}.txt', f'{split}.trace'),
     ]
     
-    txt_file = None
-    trace_file = None
-    
     for txt_pattern, trace_pattern in patterns:
-        candidate_txt = data_dir / txt_pattern
-        candidate_trace = data_dir / trace_pattern
-        if candidate_txt.exists() and candidate_trace.exists():
-            txt_file = candidate_txt
-            trace_file = candidate_trace
-            break
-    
-    if txt_file is None:
-        raise FileNotFoundError(f"Could not find data files in {data_dir}")
-    
-    print(f"Using files: {txt_file.name}, {trace_file.name}")
-    
-    # Read trace file
-    with open(trace_file, 'r') as f:
-        trace_lines = [line.strip() for line in f if line.strip()]
+        txt_file = data_dir / txt_pattern
+        trace_file = data_dir / trace_pattern
+        if txt_file.exists() and trace_file.exists():
+            print(f"Using files: {txt_file.name}, {trace_file.name}")
+            return txt_file, trace_file
     
-    # Read txt file
-    with open(txt_file, 'r') as f:
-        txt_content = f.read()
-    
-    # Split into story blocks
-    examples_raw = []
-    current_block = []
-    
-    for line in txt_content.split('\n'):
-        if line.startswith('1 ') and current_block:
-            examples_raw.append(current_block)
-            current_block = [line]
-        elif line.strip():
-            current_block.append(line)
-    if current_block:
-        examples_raw.append(current_block)
-    
-    print(f"Found {len(examples_raw)} story blocks and {len(trace_lines)} trace lines")
+    raise FileNotFoundError(f"Could not find data files in {data_dir}")
+
+
+def iter_examples(txt_file: Path, trace_file: Path) -> Iterator[ToMiExample]:
+    """
+    Stream ToMi examples from txt and trace files.
     
-    # Parse examples
-    tomi_examples = []
-    for i, (block, trace_line) in enumerate(zip(examples_raw, trace_lines)):
-        _, question_type, story_type = parse_trace_line(trace_line)
+    Control questions (memory, reality) are skipped.
+    """
+    # Stream story blocks and trace lines in lockstep; both are counted to the
+    # end so that a misaligned txt/trace pair is reported
+    num_blocks = 0
+    num_trace_lines = 0
+    num_examples = 0
+    pairs = itertools.zip_longest(iter_story_blocks(txt_file), iter_trace_lines(trace_file))
+    for block, trace_line in pairs:
+        if block is not None:
+            num_blocks += 1
+        if trace_line is not None:
+            num_trace_lines += 1
+        if block is None or trace_line is None:
+            continue
+        
+        question_type, story_type = parse_trace_line(trace_line)
         requires_tom, tom_order, base_type = parse_question_type(question_type)
-        story, question, answer = parse_story_block(block)
         
-        example = ToMiExample(
+        # Skip control questions before doing any work on the story
+        if base_type in ('memory', 'reality'):
+            continue
+        
+        story, question, answer = parse_story_block(block)
+        num_examples += 1
+        yield ToMiExample(
             story=story,
             question=question,
             answer=answer,
@@ -156,121 +230,125 @@ def load_tomi_data(data_dir: Path, split: str = 'test') -> List[ToMiExample]:
             tom_order=tom_order,
             base_question_type=base_type
         )
-        tomi_examples.append(example)
     
-    return tomi_examples
+    num_matched = min(num_blocks, num_trace_lines)
+    print(f"Found {num_blocks} story blocks and {num_trace_lines} trace lines, "
+          f"skipped {num_matched - num_examples} control questions")
+    if num_blocks != num_trace_lines:
+        print(f"WARNING: story blocks and trace lines do not line up; "
+              f"{num_blocks - num_matched} leftover story blocks and "
+              f"{num_trace_lines - num_matched} leftover trace lines were ignored")
 
 
-def group_examples(examples: List[ToMiExample]) -> Dict[str, Dict[str, List[ToMiExample]]]:
+def save_grouped_data(examples: Iterable[ToMiExample], output_dir: Path):
     """
-    Group examples by base question type and whether ToM is required.
+    Group examples by base question type and whether ToM is required, and save them.
     
-    Returns: {base_type: {'tom': [...], 'no_tom': [...]}}
+    Examples are consumed as a stream: each one is encoded and appended to its
+    group's file as it arrives, so only the first example of each group is kept.
+    Everything is written to a staging directory first, and the previous
+    outputs in output_dir are only replaced once the whole stream has been read.
     """
-    grouped = defaultdict(lambda: {'tom': [], 'no_tom': []})
-    
-    for ex in examples:
-        # Skip control questions
-        if ex.base_question_type in ('memory', 'reality'):
-            continue
-        
-        key = 'tom' if ex.requires_tom else 'no_tom'
-        grouped[ex.base_question_type][key].append(ex)
-    
-    return grouped
-
-
-def save_grouped_data(grouped: Dict, output_dir: Path):
-    """Save grouped examples."""
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Summary
-    summary = {}
-    print(f"\n{'='*60}")
-    print("SUMMARY")
-    print(f"{'='*60}")
-    
-    for base_type in sorted(grouped.keys()):
-        tom_count = len(grouped[base_type]['tom'])
-        no_tom_count = len(grouped[base_type]['no_tom'])
-        print(f"{base_type}:")
-        print(f"  ToM required:     {tom_count} examples")
-        print(f"  No ToM required:  {no_tom_count} examples")
-        summary[base_type] = {'tom': tom_count, 'no_tom': no_tom_count}
-    
-    with open(output_dir / 'summary.json', 'w') as f:
-        json.dump(summary, f, indent=2)
-    
-    # Save each group
-    for base_type in grouped:
-        for condition in ['tom', 'no_tom']:
-            examples = grouped[base_type][condition]
-            if not examples:
-                continue
-            
-            filename = f'{base_type}_{condition}.jsonl'
-            filepath = output_dir / filename
-            
-            with open(filepath, 'w') as f:
-                for ex in examples:
-                    ex_dict = {
-                        'story': ex.story,
-                        'question': ex.question,
-                        'answer': ex.answer,
-                        'question_type': ex.question_type,
-                        'story_type': ex.story_type,
-                        'requires_tom': ex.requires_tom,
-                        'tom_order': ex.tom_order,
-                    }
-                    f.write(json.dumps(ex_dict) + '\n')
-            
-            print(f"Saved: {filepath}")
-    
-    # Save combined files for easy loading
-    all_tom = []
-    all_no_tom = []
-    
-    for base_type in grouped:
-        all_tom.extend(grouped[base_type]['tom'])
-        all_no_tom.extend(grouped[base_type]['no_tom'])
-    
-    for name, examples in [('all_tom', all_tom), ('all_no_tom', all_no_tom)]:
-        filepath = output_dir / f'{name}.jsonl'
-        with open(filepath, 'w') as f:
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix='.staging_') as staging:
+        staging_dir = Path(staging)
+        
+        # {base_type: {'tom': n, 'no_tom': n}}, in first-seen order, which fixes
+        # the order of the combined output files
+        counts = {}
+        samples = {}
+        with ExitStack() as stack:
+            files = {}
             for ex in examples:
-                ex_dict = {
-                    'story': ex.story,
-                    'question': ex.question,
-                    'answer': ex.answer,
-                    'question_type': ex.question_type,
-                    'story_type': ex.story_type,
-                    'requires_tom': ex.requires_tom,
-                    'tom_order': ex.tom_order,
-                    'base_question_type': ex.base_question_type,
-                }
-                f.write(json.dumps(ex_dict) + '\n')
-        print(f"Saved: {filepath}")
-    
-    # Save human-readable samples
-    sample_file = output_dir / 'samples.txt'
-    with open(sample_file, 'w') as f:
-        for base_type in sorted(grouped.keys()):
-            f.write(f"\n{'='*60}\n")
-            f.write(f"QUESTION TYPE: {base_type}\n")
-            f.write(f"{'='*60}\n")
+                base_type = ex.base_question_type
+                condition = 'tom' if ex.requires_tom else 'no_tom'
+                f = files.get((base_type, condition))
+                if f is None:
+                    filepath = staging_dir / f'{base_type}_{condition}.jsonl'
+                    f = files[(base_type, condition)] = stack.enter_context(open(filepath, 'wb'))
+                    counts.setdefault(base_type, {'tom': 0, 'no_tom': 0})
+                    samples[(base_type, condition)] = ex
+                
+                f.write(encode_example(ex))
+                counts[base_type][condition] += 1
+        
+        # Summary
+        summary = {}
+        print(f"\n{'='*60}")
+        print("SUMMARY")
+        print(f"{'='*60}")
+        
+        for base_type in sorted(counts.keys()):
+            tom_count = counts[base_type]['tom']
+            no_tom_count = counts[base_type]['no_tom']
+            print(f"{base_type}:")
+            print(f"  ToM required:     {tom_count} examples")
+            print(f"  No ToM required:  {no_tom_count} examples")
+            summary[base_type] = {'tom': tom_count, 'no_tom': no_tom_count}
+        
+        with open(staging_dir / 'summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        
+        saved = []
+        for base_type in counts:
+            for condition in ['tom', 'no_tom']:
+                if counts[base_type][condition]:
+                    saved.append(f'{base_type}_{condition}.jsonl')
+        
+        # Combined files for easy loading, concatenated from the per-type files
+        # one group at a time
+        for condition in ['tom', 'no_tom']:
+            name = f'all_{condition}.jsonl'
+            with open(staging_dir / name, 'wb') as f:
+                for base_type in counts:
+                    if counts[base_type][condition]:
+                        lines = (staging_dir / f'{base_type}_{condition}.jsonl').read_bytes()
+                        f.write(add_base_question_type(lines, base_type))
+            saved.append(name)
+        
+        # Save human-readable samples
+        parts = []
+        for base_type in sorted(counts.keys()):
+            parts.append(f"\n{'='*60}\n")
+            parts.append(f"QUESTION TYPE: {base_type}\n")
+            parts.append(f"{'='*60}\n")
             
             for condition in ['tom', 'no_tom']:
-                examples = grouped[base_type][condition]
-                if examples:
-                    ex = examples[0]
-                    f.write(f"\n--- {condition.upper()} ---\n")
-                    f.write(f"Story type: {ex.story_type}\n")
-                    f.write(f"Question type: {ex.question_type}\n\n")
-                    f.write(ex.story + '\n\n')
-                    f.write(f"Q: {ex.question}\n")
-                    f.write(f"A: {ex.answer}\n")
-    
-    print(f"Saved samples: {sample_file}")
+                ex = samples.get((base_type, condition))
+                if ex is not None:
+                    parts.append(f"\n--- {condition.upper()} ---\n")
+                    parts.append(f"Story type: {ex.story_type}\n")
+                    parts.append(f"Question type: {ex.question_type}\n\n")
+                    parts.append(ex.story + '\n\n')
+                    parts.append(f"Q: {ex.question}\n")
+                    parts.append(f"A: {ex.answer}\n")
+        (staging_dir / 'samples.txt').write_text(''.join(parts))
+        
+        # Swap the new outputs into place
+        print(f"Replacing previous outputs in {output_dir}...")
+        clear_outputs(output_dir)
+        for filepath in staging_dir.iterdir():
+            filepath.replace(output_dir / filepath.name)
+    
+    for name in saved:
+        print(f"Saved: {output_dir / name}")
+    print(f"Saved samples: {output_dir / 'samples.txt'}")
+
+
+# Files written by save_grouped_data besides the per-type <base>_<cond>.jsonl files;
+# together with those, these are replaced on every run
+OUTPUT_NAMES = ('all_tom.jsonl', 'all_no_tom.jsonl', 'summary.json', 'samples.txt')
+
+
+def clear_outputs(output_dir: Path):
+    """Remove the outputs of a previous run, leaving any other files in output_dir alone."""
+    # Per-type files are named after whatever base types the data contained;
+    # '*_tom.jsonl' also matches the *_no_tom.jsonl ones, but not *_prompts.jsonl
+    for filepath in list(output_dir.glob('*_tom.jsonl')):
+        filepath.unlink()
+    for name in OUTPUT_NAMES:
+        (output_dir / name).unlink(missing_ok=True)
 
 
 def main():
@@ -285,21 +363,10 @@ def main():
     output_dir = Path(args.output_dir)
     
     print(f"Loading ToMi {args.split} data from {data_dir}...")
-    examples = load_tomi_data(data_dir, args.split)
-    print(f"Loaded {len(examples)} total examples")
-    
-    output_dir = Path(args.output_dir)
-    
-    # Clear previous outputs
-    if output_dir.exists():
-        print(f"Clearing previous outputs in {output_dir}...")
-        shutil.rmtree(output_dir)
-
-    print("\nGrouping examples...")
-    grouped = group_examples(examples)
+    txt_file, trace_file = find_data_files(data_dir, args.split)
     
-    print("\nSaving...")
-    save_grouped_data(grouped, output_dir)
+    print("\nGrouping and saving examples...")
+    save_grouped_data(iter_examples(txt_file, trace_file), output_dir)
     
     print("\nDone!")
 